@@ -4,159 +4,613 @@ import subprocess
 import os
 import sys
 import argparse
+import asyncio
+import functools
+import hashlib
 import json
-import requests
+import math
+import re
+import sqlite3
+from urllib.parse import parse_qs, urlsplit
+import openai
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CACHE_PATH = os.getenv('COMMIT_CACHE_PATH', os.path.join(os.path.expanduser('~'), '.cache', 'risc_git_auto_commit', 'commit_cache.db'))
+SEMANTIC_THRESHOLD = 0.97
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 30.0
+DEFAULT_API_VERSION = '2024-08-01-preview'
+MAX_LINES_PER_FILE = 200
+MAX_INPUT_TOKENS = 6000
+MAX_OUTPUT_TOKENS = 800
+# JSON keys, quoting and the category label per result, and the {"results": [...]} wrapper
+RESULT_OVERHEAD_TOKENS = 60
+MIN_REPLY_TOKENS = 300
+MAX_CONCURRENT_SUMMARIES = 8
+TOKENIZER_MODEL = 'gpt-4o-mini'
+# Unquoted non-ASCII paths in diff headers, so they match the names from git status;
+# the rest pins the output format split_diff() parses against user config
+# (diff.noprefix, color.diff=always, external diff drivers, textconv filters)
+DIFF_CMD = [
+    'git', '-c', 'core.quotePath=false', '--literal-pathspecs', 'diff',
+    '--no-color', '--no-ext-diff', '--no-textconv', '--src-prefix=a/', '--dst-prefix=b/',
+]
+
+CATEGORIES = ('dts', 'config', 'drivers', 'script', 'patch', 'other')
+# Anchored alternatives are tried in order, so earlier categories win like an if/elif chain
+CLASSIFY_RE = re.compile(
+    r'(?P<dts>.*\.dtsi?\Z)'
+    r'|(?P<config>.*(?i:config))'
+    r'|(?P<drivers>drivers/|.*\.[ch]\Z)'
+    r'|(?P<script>.*\.(?:sh|py|pl)\Z|.*(?i:build|script))'
+    r'|(?P<patch>.*\.patch\Z)',
+    re.S
+)
+
+SYSTEM_PROMPT = """You write concise structured commit messages for git diffs.
+Each diff starts with "### category=<name>" (its change type), followed by "file: <path>" blocks holding only the added (+) and removed (-) lines.
+For each diff determine cpu (imx8mm, imx8mp, imx93), machine (ROM-5721, ROM-5722, ROM-2820) and type (dts, drivers, config, kconfig, script, patch), using "unknown" when undeterminable.
+If the header already gives cpu, machine and type, omit those three fields for that diff.
+Write a brief but descriptive title and at most 2-3 short, non-redundant details covering only the most important changes.
+Reply with JSON only, one entry per diff in order:
+{"results": [{"category": "...", "cpu": "...", "machine": "...", "type": "...", "title": "...", "details": ["...", "..."]}]}"""
+
+CPU_RE = re.compile(r'imx(8mm|8mp|93)', re.I)
+MACHINE_RE = re.compile(r'rom-?(5721|5722|2820)', re.I)
+
+SUMMARY_PROMPT = """Summarize the following single-file git diff (only +/- lines are shown) in 1-3 short lines.
+Name the functions, device tree nodes, config options or commands that changed. Reply with the summary only."""
+
+class CommitCache:
+    """SQLite-backed cache of diff analyses, with optional embedding similarity lookup.
+
+    Caching is only an optimisation: if the database cannot be opened, read or written,
+    it is switched off and every lookup misses. A path of None disables it up front.
+    """
+    def __init__(self, path):
+        self.conn = None
+        if path is None:
+            return
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.conn = sqlite3.connect(path)
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS analysis ('
+                'key TEXT PRIMARY KEY, category TEXT, result TEXT NOT NULL, embedding TEXT)'
+            )
+            self.conn.execute('CREATE TABLE IF NOT EXISTS token_counts (key TEXT PRIMARY KEY, tokens INTEGER NOT NULL)')
+            self.conn.commit()
+        except (sqlite3.Error, OSError) as e:
+            self.disable(e)
+
+    def disable(self, error):
+        print(f"Commit cache unavailable, continuing without it: {error}")
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except sqlite3.Error:
+                pass
+        self.conn = None
+
+    def _fetch(self, sql, params):
+        """Return all rows of a query, or [] when the cache is off or fails"""
+        if self.conn is None:
+            return []
+        try:
+            return self.conn.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            self.disable(e)
+            return []
+
+    def _write(self, sql, params):
+        if self.conn is None:
+            return
+        try:
+            self.conn.execute(sql, params)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.disable(e)
+
+    @staticmethod
+    def make_key(diff_content, category):
+        """Hash category + diff, ignoring whitespace-only differences"""
+        normalized = " ".join(diff_content.split())
+        return hashlib.sha256(f"{category}\0{normalized}".encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def get(self, key):
+        rows = self._fetch('SELECT result FROM analysis WHERE key = ?', (key,))
+        try:
+            return loads_json(rows[0][0]) if rows else None
+        except ValueError:
+            # Damaged entry: treat as a miss, the fresh result overwrites it
+            return None
+
+    def nearest(self, category, embedding, threshold=SEMANTIC_THRESHOLD):
+        """Return the cached result most similar to embedding if above threshold"""
+        best, best_score = None, threshold
+        rows = self._fetch(
+            'SELECT result, embedding FROM analysis WHERE category IS ? AND embedding IS NOT NULL', (category,)
+        )
+        try:
+            for result, stored in rows:
+                score = cosine_similarity(embedding, loads_json(stored))
+                if score >= best_score:
+                    best, best_score = result, score
+            return loads_json(best) if best else None
+        except ValueError:
+            return None
+
+    def count_tokens(self, text):
+        """count_tokens() memoized by text hash, so retries and reruns skip re-encoding"""
+        encoder = _encoder()
+        if encoder is None:
+            return count_tokens(text)
+        key = hashlib.sha256(f"{encoder.name}\0{text}".encode('utf-8', 'surrogateescape')).hexdigest()
+        rows = self._fetch('SELECT tokens FROM token_counts WHERE key = ?', (key,))
+        if rows:
+            return rows[0][0]
+        tokens = count_tokens(text)
+        self._write('INSERT OR REPLACE INTO token_counts (key, tokens) VALUES (?, ?)', (key, tokens))
+        return tokens
+
+    def put(self, key, category, result, embedding=None):
+        self._write(
+            'INSERT OR REPLACE INTO analysis (key, category, result, embedding) VALUES (?, ?, ?, ?)',
+            (key, category, json.dumps(result), json.dumps(embedding) if embedding else None)
+        )
+
+@functools.lru_cache(maxsize=None)
+def _encoder():
+    """Load the tokenizer once; None if tiktoken is missing or its BPE file cannot be fetched"""
+    if tiktoken is None:
+        return None
+    # Keep the downloaded BPE file next to our cache instead of tiktoken's default temp dir
+    os.environ.setdefault('TIKTOKEN_CACHE_DIR', os.path.join(os.path.dirname(CACHE_PATH), 'tiktoken'))
+    try:
+        return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    except Exception as e:
+        print(f"tiktoken unavailable, estimating tokens from length: {e}")
+        return None
+
+def loads_json(data):
+    """Parse JSON with orjson when installed, else the stdlib parser"""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+@functools.lru_cache(maxsize=32)
+def _classify(files):
+    """Bucket a tuple of paths by CATEGORIES, returning a tuple of tuples"""
+    buckets = {name: [] for name in CATEGORIES}
+    for f in files:
+        m = CLASSIFY_RE.match(f)
+        buckets[m.lastgroup if m else 'other'].append(f)
+    return tuple(tuple(buckets[name]) for name in CATEGORIES)
+
+C_ESCAPES = {'a': 7, 'b': 8, 't': 9, 'n': 10, 'v': 11, 'f': 12, 'r': 13, '"': 34, '\\': 92}
+
+def unquote_c_path(quoted):
+    """Undo git's C-style quoting of a path, e.g. "b/t\\tab.sh" -> b/t<TAB>ab.sh"""
+    raw = os.fsencode(quoted[1:-1])
+    out, i = bytearray(), 0
+    while i < len(raw):
+        if raw[i] == ord('\\'):
+            escape = chr(raw[i + 1])
+            if escape in '01234567':
+                # \ooo octal byte
+                out.append(int(raw[i + 1:i + 4], 8))
+                i += 4
+                continue
+            out.append(C_ESCAPES[escape])
+            i += 2
+            continue
+        out.append(raw[i])
+        i += 1
+    return os.fsdecode(bytes(out))
+
+def to_utf8(text):
+    """Replace undecodable bytes kept by os.fsdecode with U+FFFD before text is sent to the API"""
+    return os.fsencode(text).decode('utf-8', 'replace')
+
+def count_tokens(text):
+    """Estimate the number of tokens in text (tiktoken if available, else ~4 characters per token)"""
+    encoder = _encoder()
+    if encoder is None:
+        return len(text) // 4
+    return len(encoder.encode(text, disallowed_special=()))
+
+def truncate_tokens(text, limit):
+    """Cut text down to about limit tokens, measured like count_tokens()"""
+    encoder = _encoder()
+    if encoder is None:
+        return text[:limit * 4]
+    return encoder.decode(encoder.encode(text, disallowed_special=())[:limit])
+
+def parse_azure_endpoint(url):
+    """Split a full Azure OpenAI deployment URL into (resource endpoint, deployment, api version)"""
+    parts = urlsplit(url)
+    match = re.search(r'/openai/deployments/([^/]+)', parts.path)
+    if not match:
+        raise ValueError(f"Expected an Azure OpenAI deployment URL (.../openai/deployments/<name>/...), got: {url}")
+    api_version = parse_qs(parts.query).get('api-version', [DEFAULT_API_VERSION])[0]
+    return f"{parts.scheme}://{parts.netloc}", match.group(1), api_version
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
 
 class GitCommitAPI:
-    def __init__(self):
+    def __init__(self, use_cache=True):
         self.api_key = os.getenv('OPENAI_API_KEY')
         self.endpoint = os.getenv('OPENAI_ENDPOINT')
+        # Optional embeddings deployment (e.g. text-embedding-3-small) for the semantic cache tier
+        self.embedding_endpoint = os.getenv('OPENAI_EMBEDDING_ENDPOINT')
+        # Optional cheaper deployment (e.g. gpt-4o-mini) for summarizing oversized diffs
+        self.summary_endpoint = os.getenv('OPENAI_SUMMARY_ENDPOINT') or self.endpoint
         if not self.api_key or not self.endpoint:
             raise ValueError("Please export OPENAI_API_KEY and OPENAI_ENDPOINT to your environment before running this script.")
-        self.headers = {
-            'Content-Type': 'application/json',
-            'api-key': self.api_key
+        # (resource endpoint, deployment, api version) per role; None when the role is disabled
+        self.deployments = {
+            'chat': parse_azure_endpoint(self.endpoint),
+            'summary': parse_azure_endpoint(self.summary_endpoint),
+            'embedding': parse_azure_endpoint(self.embedding_endpoint) if self.embedding_endpoint else None
         }
         self.valid_cpus = ['imx8mm', 'imx8mp', 'imx93']
         self.valid_machines = ['ROM-5721', 'ROM-5722', 'ROM-2820']
         self.valid_types = ['dts', 'drivers', 'config', 'kconfig', 'script', 'patch']
+        self.clients = {}
+        self.cache = CommitCache(CACHE_PATH if use_cache else None)
+        # category -> (key, analysis, embedding), written to the cache once its commit lands
+        self.unsaved = {}
+
+    async def __aenter__(self):
+        # One pooled client per Azure resource; the SDK retries 429/5xx honoring Retry-After
+        for endpoint, _, api_version in filter(None, self.deployments.values()):
+            if (endpoint, api_version) not in self.clients:
+                self.clients[(endpoint, api_version)] = openai.AsyncAzureOpenAI(
+                    api_key=self.api_key,
+                    azure_endpoint=endpoint,
+                    api_version=api_version,
+                    max_retries=MAX_RETRIES,
+                    timeout=REQUEST_TIMEOUT
+                )
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        for client in self.clients.values():
+            await client.close()
+        self.clients = {}
+
+    def client_for(self, role):
+        """Return (client, deployment name) for 'chat', 'summary' or 'embedding'"""
+        endpoint, deployment, api_version = self.deployments[role]
+        return self.clients[(endpoint, api_version)], deployment
+
+    def _diff_path(self, header):
+        """Return the post-image path of a 'diff --git a/<old> b/<new>' header line"""
+        names = header[len('diff --git '):]
+        if names.endswith('"'):
+            # Paths with tabs, newlines, '"' or '\\' are C-quoted even with core.quotePath=false.
+            # An unescaped ' "' cannot occur inside a quoted path, so it marks the start of the b/ side.
+            return unquote_c_path(names[names.rfind(' "b/') + 1:])[len('b/'):]
+        # Unless renamed, both halves are the same path, which also handles paths containing ' b/'
+        half = (len(names) - 1) // 2
+        if names[2:half] == names[half + 3:]:
+            return names[half + 3:]
+        return names.split(' b/', 1)[-1]
 
-    def extract_json_from_markdown(self, content):
-        """Extract JSON from Markdown-formatted response"""
+    def split_diff(self, diff_content):
+        """Split a multi-file diff into {path: diff of that file}"""
+        diff_map = {}
+        for block in re.split(r'^(?=diff --git )', diff_content, flags=re.M):
+            if block.startswith('diff --git '):
+                diff_map[self._diff_path(block.split('\n', 1)[0])] = block
+        return diff_map
+
+    def _compact_diff(self, diff_content):
+        """Reduce a unified diff to its +/- lines grouped by file, capped per file"""
+        out, kept, dropped, in_hunk = [], 0, 0, False
+
+        def flush():
+            if dropped:
+                out.append(f"... ({dropped} more lines)")
+
+        for line in diff_content.splitlines():
+            if line.startswith('diff --git '):
+                flush()
+                out.append(f"file: {self._diff_path(line)}")
+                kept, dropped, in_hunk = 0, 0, False
+            elif line.startswith('@@'):
+                in_hunk = True
+            elif not in_hunk:
+                # Keep the few header lines that carry meaning, drop index/---/+++ noise
+                if line.startswith(('new file', 'deleted file', 'rename ', 'Binary files')):
+                    out.append(line)
+            elif line.startswith(('+', '-')):
+                if kept < MAX_LINES_PER_FILE:
+                    out.append(line)
+                    kept += 1
+                else:
+                    dropped += 1
+        flush()
+        return to_utf8("\n".join(out))
+
+    async def read_stream(self, stream):
+        """Echo a streamed chat completion as it arrives and return (content, finish_reason)"""
+        parts, finish_reason = [], None
+        async for chunk in stream:
+            # Azure sends a leading chunk with empty choices (prompt filter results)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                print(delta, end='', flush=True)
+                parts.append(delta)
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+        print()
+        return "".join(parts), finish_reason
+
+    async def embed(self, text):
+        """Return the embedding vector of text, or None if unavailable"""
+        client, deployment = self.client_for('embedding')
         try:
-            json_start = content.find('{')
-            json_end = content.rfind('}') + 1
-            if json_start != -1 and json_end != -1:
-                json_content = content[json_start:json_end]
-                return json.loads(json_content)
+            # Stay well below the 8k-token input limit of the embedding models
+            result = await client.embeddings.create(model=deployment, input=to_utf8(text[:24000]))
+            return result.data[0].embedding
+        except openai.APIStatusError as e:
+            print(f"Embedding API Error: {e.status_code}")
             return None
         except Exception as e:
-            print(f"Error extracting JSON: {e}")
+            print(f"Error fetching embedding: {e}")
             return None
 
-    def analyze_with_azure_openai(self, diff_content, category=None):
+    async def summarize(self, file_diff):
+        """Return a short summary of a single-file compact diff, or None if unavailable"""
+        client, deployment = self.client_for('summary')
+        try:
+            result = await client.chat.completions.create(
+                model=deployment,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": file_diff}
+                ],
+                temperature=0,
+                max_tokens=100
+            )
+            return result.choices[0].message.content.strip()
+        except openai.APIStatusError as e:
+            print(f"Summary API Error: {e.status_code}")
+            return None
+        except Exception as e:
+            print(f"Error summarizing diff: {e}")
+            return None
+
+    async def fit_token_budget(self, compact):
+        """Replace oversized entries of {item: compact diff} with per-file summaries"""
+        share = MAX_INPUT_TOKENS // len(compact)
+        oversized = [i for i, text in compact.items() if self.cache.count_tokens(text) > share]
+        blocks = {i: re.split(r'^(?=file: )', compact[i], flags=re.M) for i in oversized}
+        jobs = [(i, n, block) for i in oversized for n, block in enumerate(blocks[i]) if block.strip()]
+        print(f"Diff exceeds {MAX_INPUT_TOKENS} tokens, summarizing {len(jobs)} files...")
+        # Large changesets touch hundreds of files; don't open a request for each at once
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_SUMMARIES)
+        async def bounded(block):
+            async with semaphore:
+                return await self.summarize(block)
+        summaries = await asyncio.gather(*(bounded(block) for _, _, block in jobs))
+        for (i, n, block), summary in zip(jobs, summaries):
+            header, _, body = block.partition('\n')
+            # Without a summary keep the head of the file diff rather than dropping it
+            text = summary or "\n".join(body.splitlines()[:20])
+            blocks[i][n] = f"{header}\n{text}\n"
+        fitted = {**compact, **{i: "".join(blocks[i]) for i in oversized}}
+        # Many files still add up to many summary lines; cut what remains over its share
+        if sum(self.cache.count_tokens(text) for text in fitted.values()) > MAX_INPUT_TOKENS:
+            print(f"Summaries still exceed {MAX_INPUT_TOKENS} tokens, truncating...")
+            fitted = {
+                i: truncate_tokens(text, share) if self.cache.count_tokens(text) > share else text
+                for i, text in fitted.items()
+            }
+        return fitted
+
+    async def lookup_cache(self, diff_content, category):
+        """Return (key, embedding, cached analysis or None) for one diff"""
+        label = category.upper() if category else "diff"
+        key = self.cache.make_key(diff_content, category)
+        cached = self.cache.get(key)
+        if cached:
+            print(f"Using cached {label} analysis")
+            return key, None, cached
+        embedding = None
+        if self.embedding_endpoint:
+            embedding = await self.embed(diff_content)
+            cached = self.cache.nearest(category, embedding) if embedding else None
+            if cached:
+                print(f"Using cached {label} analysis (similar diff)")
+                self.unsaved[category] = (key, cached, embedding)
+        return key, embedding, cached
+
+    async def analyze_with_azure_openai(self, diff_content, category=None):
         """Use Azure OpenAI API to analyze diff content"""
+        return (await self.analyze_many([(diff_content, category)]))[0]
+
+    def save_analysis(self, category):
+        """Cache the analysis for category; called only after the user committed it"""
+        if category in self.unsaved:
+            key, analysis, embedding = self.unsaved.pop(category)
+            self.cache.put(key, category, analysis, embedding)
+
+    def apply_context(self, analysis, context, override):
+        """Return a copy of analysis with guess_context() fields merged in.
+
+        With override the path-derived fields replace the analysis' own, otherwise
+        they only fill in fields that are missing or unknown.
+        """
+        analysis = dict(analysis)
+        for field, value in context.items():
+            if override or analysis.get(field, 'unknown') in ('', 'unknown'):
+                analysis[field] = value
+        return analysis
+
+    def guess_context(self, files, category=None):
+        """Infer cpu/machine/type from file paths; only unambiguous fields are returned"""
+        joined = "\n".join(files)
+        cpus = {f"imx{m.lower()}" for m in CPU_RE.findall(joined)}
+        machines = {f"ROM-{m}" for m in MACHINE_RE.findall(joined)}
+        context = {}
+        if len(cpus) == 1:
+            context['cpu'] = cpus.pop()
+        if len(machines) == 1:
+            context['machine'] = machines.pop()
+        if category in self.valid_types:
+            context['type'] = category
+        return context
+
+    async def analyze_many(self, items, contexts=None):
+        """Analyze several (diff_content, category) pairs with a single API request.
+
+        contexts optionally gives a guess_context() dict per item; fully resolved
+        items only ask the model for title and details.
+        Returns the analyses in the same order as items, None for failures.
+        """
+        contexts = contexts or [{} for _ in items]
+        lookups = await asyncio.gather(*(self.lookup_cache(diff, category) for diff, category in items))
+        # A cached result may come from a similar diff elsewhere, so the paths always win
+        analyses = [
+            self.apply_context(cached, context, override=True) if cached else None
+            for (_, _, cached), context in zip(lookups, contexts)
+        ]
+        pending = [i for i, analysis in enumerate(analyses) if not analysis]
+        if not pending:
+            return analyses
         try:
-            category_hint = ""
-            if category:
-                category_hint = f"\nThe change type for this diff is **{category}**."
+            compact = {i: self._compact_diff(items[i][0]) for i in pending}
+            if sum(self.cache.count_tokens(text) for text in compact.values()) > MAX_INPUT_TOKENS:
+                compact = await self.fit_token_budget(compact)
+            resolved = {i for i in pending if len(contexts[i]) == 3}
+            sections = "\n\n".join(
+                f"### category={items[i][1] or 'unknown'}"
+                + "".join(f" {field}={value}" for field, value in contexts[i].items() if i in resolved)
+                + f"\n{compact[i]}"
+                for i in pending
+            )
             messages = [
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant that analyzes git diffs and generates concise structured commit messages."
-                },
-                {
-                    "role": "user",
-                    "content": f"""Analyze the following git diff and generate a CONCISE commit message in the format [cpu][machine][type] title followed by details.
-The cpu can be: imx8mm, imx8mp, imx93
-The machine can be: ROM-5721, ROM-5722, ROM-2820
-The type can be: dts, drivers, config, kconfig, script, patch
-{category_hint}
-
-Requirements for the response:
-1. Title should be brief but descriptive
-2. Details should be limited to 2-3 key points maximum
-3. Each detail should be short and focused
-4. Avoid redundant information
-5. Focus only on the most important changes
-
-If any of cpu, machine, or type cannot be determined, set its value to "unknown".
-
-The diff content is:
-
-{diff_content}
-
-Please return a JSON object in this format:
-{{
-    "cpu": "detected_cpu",
-    "machine": "detected_machine",
-    "type": "change_type",
-    "title": "brief_title",
-    "details": ["key_point1", "key_point2"]
-}}"""
-                }
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": sections}
             ]
-            payload = {
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 800
-            }
-            print("Sending request to Azure OpenAI API...")
-            response = requests.post(
-                self.endpoint,
-                headers=self.headers,
-                json=payload
-            )
-            print(f"Response status code: {response.status_code}")
-
-            if response.status_code == 200:
-                result = response.json()
-                content = result['choices'][0]['message']['content']
-                print(f"Generated content: {content}")
-                return self.extract_json_from_markdown(content)
-            else:
-                print(f"API Error: {response.status_code}")
-                print(f"Response: {response.text}")
-                return None
+            # A title plus 2-3 details needs ~120 tokens; allow a little more per touched file
+            max_tokens = max(MIN_REPLY_TOKENS, sum(
+                RESULT_OVERHEAD_TOKENS
+                + (120 if i in resolved else min(MAX_OUTPUT_TOKENS, 120 + 4 * len(re.findall(r'^file: ', compact[i], re.M))))
+                for i in pending
+            ))
+            label = ", ".join((items[i][1] or "diff").upper() for i in pending)
+            print(f"Sending {label} request to Azure OpenAI API...")
+            client, deployment = self.client_for('chat')
+            for attempt in range(2):
+                stream = await client.chat.completions.create(
+                    model=deployment,
+                    messages=messages,
+                    temperature=0.2,
+                    max_tokens=max_tokens,
+                    # JSON mode: the reply is a bare JSON object, no Markdown fences to strip
+                    response_format={"type": "json_object"},
+                    stream=True
+                )
+                print("Generated content: ", end='')
+                content, finish_reason = await self.read_stream(stream)
+                # A reply cut off mid-JSON is useless; retry once with room to finish
+                if finish_reason != 'length' or attempt:
+                    break
+                max_tokens *= 2
+                print(f"Reply hit the token limit, retrying with max_tokens={max_tokens}...")
+            try:
+                parsed = loads_json(content)
+            except ValueError as e:
+                # e.g. the reply was cut off by max_tokens
+                print(f"Error parsing JSON reply: {e}")
+                parsed = {}
+            results = [r for r in parsed.get('results', [parsed]) if isinstance(r, dict) and r]
+            by_category = {r.get('category'): r for r in results}
+            # Position only identifies a result if none are labelled or none are missing
+            positional = not any('category' in r for r in results) or len(results) == len(pending)
+            for n, i in enumerate(pending):
+                diff_content, category = items[i]
+                expected = category or 'unknown'
+                analysis = by_category.get(expected)
+                if not analysis and positional and n < len(results):
+                    analysis = results[n]
+                if analysis:
+                    # Never persist a result the model labelled as another category
+                    if analysis.get('category', expected) == expected:
+                        key, embedding, _ = lookups[i]
+                        self.unsaved[category] = (key, analysis, embedding)
+                    # Path-derived fields win when fully resolved, otherwise only fill in unknowns
+                    analysis = self.apply_context(analysis, contexts[i], override=i in resolved)
+                else:
+                    print(f"No analysis returned for {expected.upper()}")
+                analyses[i] = analysis
 
+        except openai.APIStatusError as e:
+            print(f"API Error: {e.status_code}")
+            print(f"Response: {e.message}")
         except Exception as e:
             print(f"Error analyzing with Azure OpenAI: {e}")
             import traceback
             traceback.print_exc()
-            return None
+        return analyses
 
-    def get_changed_files(self, repo_path):
-        """Return a list of changed (unstaged + staged) files"""
-        original_dir = os.getcwd()
-        os.chdir(repo_path)
-        files = set()
-        # unstaged
-        out = subprocess.check_output(['git', 'diff', '--name-only']).decode().splitlines()
-        files.update(out)
-        # staged
-        out = subprocess.check_output(['git', 'diff', '--cached', '--name-only']).decode().splitlines()
-        files.update(out)
-        os.chdir(original_dir)
-        return list(files)
-
-    def get_untracked_files(self, repo_path):
-        """Return a list of untracked (new) files"""
-        original_dir = os.getcwd()
-        os.chdir(repo_path)
-        out = subprocess.check_output(['git', 'ls-files', '--others', '--exclude-standard']).decode().splitlines()
-        os.chdir(original_dir)
-        return out
+    def get_status(self, repo_path):
+        """Return (staged, unstaged, untracked) file sets from a single git status call"""
+        out = subprocess.check_output(
+            ['git', 'status', '--porcelain=v2', '-z', '--untracked-files=all'], cwd=repo_path
+        )
+        staged, unstaged, untracked = set(), set(), set()
+        # Split the raw buffer on NUL; os.fsdecode keeps non-UTF-8 names intact for later git args
+        entries = map(os.fsdecode, out.split(b'\0'))
+        for entry in entries:
+            kind = entry[:1]
+            if kind == '?':
+                untracked.add(entry[2:])
+            elif kind in ('1', '2', 'u'):
+                # 1: ordinary, 2: rename/copy (original path follows as its own entry), u: unmerged
+                fields = entry.split(' ', {'1': 8, '2': 9, 'u': 10}[kind])
+                xy, path = fields[1], fields[-1]
+                if kind == 'u' or xy[1] != '.':
+                    unstaged.add(path)
+                if kind != 'u' and xy[0] != '.':
+                    staged.add(path)
+                if kind == '2':
+                    staged.add(next(entries))
+        return staged, unstaged, untracked
 
     def classify_files(self, files):
         """Classify files into dts, config, drivers, script, patch, others"""
-        dts_files, config_files, drivers_files, script_files, patch_files, other_files = [], [], [], [], [], []
-        for f in files:
-            if f.endswith(('.dts', '.dtsi')):
-                dts_files.append(f)
-            elif any(k in f.lower() for k in ('config', 'kconfig')):
-                config_files.append(f)
-            elif f.startswith('drivers/') or f.endswith('.c') or f.endswith('.h'):
-                drivers_files.append(f)
-            elif f.endswith('.sh') or f.endswith('.py') or f.endswith('.pl') or 'build' in f.lower() or 'script' in f.lower():
-                script_files.append(f)
-            elif f.endswith('.patch'):
-                patch_files.append(f)
-            else:
-                other_files.append(f)
-        return dts_files, config_files, drivers_files, script_files, patch_files, other_files
+        return tuple(list(bucket) for bucket in _classify(tuple(files)))
 
     def get_diff_for_files(self, repo_path, files):
-        """Get diff for the specified files (staged + unstaged)"""
+        """Get diff for the specified files (staged + unstaged, i.e. working tree vs HEAD)"""
         if not files:
             return ""
-        original_dir = os.getcwd()
-        os.chdir(repo_path)
-        # staged
-        staged = subprocess.check_output(['git', 'diff', '--cached'] + files).decode('utf-8')
-        # unstaged
-        unstaged = subprocess.check_output(['git', 'diff'] + files).decode('utf-8')
-        os.chdir(original_dir)
-        return staged + "\n" + unstaged
+        base = 'HEAD'
+        if subprocess.run(['git', 'rev-parse', '-q', '--verify', 'HEAD'], cwd=repo_path, stdout=subprocess.DEVNULL).returncode:
+            # No commits yet: diff against the empty tree, hashed by git so SHA-256 repos work too
+            base = subprocess.check_output(
+                ['git', 'hash-object', '-t', 'tree', '--stdin'], cwd=repo_path, input=b''
+            ).decode().strip()
+        out = subprocess.check_output(DIFF_CMD + [base, '--'] + files, cwd=repo_path)
+        # Same decoding as get_status(), so non-UTF-8 paths match in split_diff()
+        return os.fsdecode(out)
 
     def manual_select(self, prompt, valid_list):
         """Let user manually select or input value freely"""
@@ -176,21 +630,26 @@ Please return a JSON object in this format:
                 print("Invalid input, please try again.")
 
     def execute_commit(self, repo_path, files, commit_message):
-        """Stage files and commit"""
+        """Commit only the given (already staged) files"""
         if not files:
             return False
-        original_dir = os.getcwd()
-        os.chdir(repo_path)
         try:
-            subprocess.run(['git', 'add'] + files, check=True)
-            subprocess.run(['git', 'commit', '-m', commit_message], check=True)
+            # Literal pathspecs: a file named e.g. "*.dts" must not sweep in other staged files
+            subprocess.run(
+                ['git', '--literal-pathspecs', 'commit', '-m', commit_message, '--'] + files, cwd=repo_path, check=True
+            )
             print(f"Committed: {commit_message.splitlines()[0]}")
             return True
         except subprocess.CalledProcessError as e:
             print(f"Error during commit: {e}")
             return False
-        finally:
-            os.chdir(original_dir)
+
+    def pending_operation(self, repo_path):
+        """Return the name of an unfinished merge/cherry-pick/revert, or None"""
+        for ref, name in (('MERGE_HEAD', 'merge'), ('CHERRY_PICK_HEAD', 'cherry-pick'), ('REVERT_HEAD', 'revert')):
+            if subprocess.run(['git', 'rev-parse', '-q', '--verify', ref], cwd=repo_path, stdout=subprocess.DEVNULL).returncode == 0:
+                return name
+        return None
 
     def push_changes(self, repo_path):
         """Run git push"""
@@ -202,14 +661,33 @@ Please return a JSON object in this format:
             print(f"Error during push: {e}")
             return False
 
-def process_category(committer, repo_path, files, category):
-    if not files:
-        return
-    diff_content = committer.get_diff_for_files(repo_path, files)
-    if not diff_content.strip():
-        print(f"No diff for {category.upper()}")
-        return
-    analysis = committer.analyze_with_azure_openai(diff_content, category=category)
+async def analyze_categories(committer, repo_path, categories):
+    """Collect diffs and analyze all categories in one batched request"""
+    # One diff for the whole change set, sliced per category in memory.
+    # git diff and the tokenizer load both block, so overlap them in worker threads.
+    all_files = [f for _, files in categories for f in files]
+    full_diff, _ = await asyncio.gather(
+        asyncio.to_thread(committer.get_diff_for_files, repo_path, all_files),
+        asyncio.to_thread(_encoder)
+    )
+    diff_map = committer.split_diff(full_diff)
+    pending = []
+    for category, files in categories:
+        diff_content = "".join(diff_map[f] for f in files if f in diff_map)
+        if not diff_content.strip():
+            print(f"No diff for {category.upper()}")
+            continue
+        pending.append((category, files, diff_content))
+    if not pending:
+        return []
+    async with committer:
+        analyses = await committer.analyze_many(
+            [(diff_content, category) for category, _, diff_content in pending],
+            [committer.guess_context(files, category) for category, files, _ in pending]
+        )
+    return [(category, files, analysis) for (category, files, _), analysis in zip(pending, analyses)]
+
+def process_category(committer, repo_path, files, category, analysis):
     if not analysis:
         print(f"Failed to analyze {category} changes, skipping.")
         return
@@ -228,50 +706,44 @@ def process_category(committer, repo_path, files, category):
     print(commit_message)
     print("-" * 50)
     if input(f"\nCommit {category.upper()} changes? (y/n): ").lower() == 'y':
-        committer.execute_commit(repo_path, files, commit_message)
+        # Rejected analyses stay out of the cache so a rerun asks the model again
+        if committer.execute_commit(repo_path, files, commit_message):
+            committer.save_analysis(category)
 
 def main():
     parser = argparse.ArgumentParser(description='Auto categorize and commit DTS/CONFIG/DRIVERS/SCRIPT/PATCH using Azure OpenAI')
     parser.add_argument('repo_path', help='Path to the git repository')
+    parser.add_argument('--no-cache', action='store_true', help='Neither read nor write the response cache')
     args = parser.parse_args()
     repo_path = args.repo_path
 
     if not os.path.isdir(repo_path) or not os.path.isdir(os.path.join(repo_path, '.git')):
-        print(f"Error: {repo_path} is not a valid git repository")
+        print(f"Error: {to_utf8(repo_path)} is not a valid git repository")
         return
 
-    committer = GitCommitAPI()
+    committer = GitCommitAPI(use_cache=not args.no_cache)
 
-    # 1. Get changed (modified/staged) files
-    changed_files = committer.get_changed_files(repo_path)
+    # git refuses partial commits while these are in progress, so the per-category split cannot work
+    operation = committer.pending_operation(repo_path)
+    if operation:
+        print(f"Error: a {operation} is in progress; conclude it with 'git commit' (or abort it) before running this script")
+        return
 
-    # 2. Get untracked (new) files, and auto-add to staging if any
-    untracked_files = committer.get_untracked_files(repo_path)
+    # 1. Get changed (modified/staged) and untracked (new) files in one pass
+    staged_files, unstaged_files, untracked_files = committer.get_status(repo_path)
     if untracked_files:
-        print(f"\nFound new files:\n" + "\n".join(untracked_files))
-        # 直接自動加入 staging，不詢問
-        original_dir = os.getcwd()
-        os.chdir(repo_path)
-        try:
-            subprocess.run(['git', 'add'] + untracked_files, check=True)
-            print("Automatically added new files to staging.")
-            # Need to refresh changed_files (since staged)
-            changed_files = committer.get_changed_files(repo_path)
-        finally:
-            os.chdir(original_dir)
-
-    # 3. 自動 add 所有已變動（但尚未 staged）的 tracked 檔案
-    if changed_files:
-        print(f"\nAutomatically adding all changed files to staging:\n" + "\n".join(changed_files))
-        original_dir = os.getcwd()
-        os.chdir(repo_path)
-        try:
-            subprocess.run(['git', 'add'] + changed_files, check=True)
-            print("Automatically added changed files to staging.")
-            # 再次 refresh changed_files
-            changed_files = committer.get_changed_files(repo_path)
-        finally:
-            os.chdir(original_dir)
+        # Paths keep undecodable bytes as surrogates for git; print them with U+FFFD instead
+        print(f"\nFound new files:\n" + to_utf8("\n".join(sorted(untracked_files))))
+
+    # 2. 自動 add 新檔案與所有已變動（但尚未 staged）的檔案；已 staged 的檔案不必再 add
+    to_add = sorted(unstaged_files | untracked_files)
+    if to_add:
+        print(f"\nAutomatically adding changed files to staging:\n" + to_utf8("\n".join(to_add)))
+        subprocess.run(['git', '--literal-pathspecs', 'add', '-A', '--'] + to_add, cwd=repo_path, check=True)
+        print("Automatically added changed files to staging.")
+
+    # Everything is staged now, so the file set is known without asking git again
+    changed_files = sorted(staged_files | unstaged_files | untracked_files)
 
     if not changed_files:
         print("No changes to commit")
@@ -279,18 +751,20 @@ def main():
 
     dts_files, config_files, drivers_files, script_files, patch_files, other_files = committer.classify_files(changed_files)
 
-    if dts_files:
-        process_category(committer, repo_path, dts_files, 'dts')
-    if config_files:
-        process_category(committer, repo_path, config_files, 'config')
-    if drivers_files:
-        process_category(committer, repo_path, drivers_files, 'drivers')
-    if script_files:
-        process_category(committer, repo_path, script_files, 'script')
-    if patch_files:
-        process_category(committer, repo_path, patch_files, 'patch')
-    if other_files:
-        process_category(committer, repo_path, other_files, 'other')
+    categories = [
+        ('dts', dts_files),
+        ('config', config_files),
+        ('drivers', drivers_files),
+        ('script', script_files),
+        ('patch', patch_files),
+        ('other', other_files),
+    ]
+    categories = [(category, files) for category, files in categories if files]
+
+    # All categories are analyzed up front; interactive prompts follow once that is done
+    results = asyncio.run(analyze_categories(committer, repo_path, categories))
+    for category, files, analysis in results:
+        process_category(committer, repo_path, files, category, analysis)
 
     if input("\nAll commits done. Push now? (y/n): ").lower() == 'y':
         committer.push_changes(repo_path)